@@ -1,14 +1,25 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import asyncio
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
 import os
 from PIL import Image
 import io
 import json
+import orjson
+import hashlib
 from datetime import datetime
 import zipfile
-from dotenv import load_dotenv
 import tempfile
+from dotenv import load_dotenv
 import time
+import atexit
+import random
 import base64
 
 # Load environment variables
@@ -18,8 +29,40 @@ load_dotenv()
 LEONARDO_API_KEY = os.getenv('LEONARDO_API_KEY')
 LEONARDO_API_URL = "https://cloud.leonardo.ai/api/rest/v1"
 MAX_IMAGES = 252
-MAX_RETRIES = 30
-RETRY_DELAY = 2
+IMAGE_WIDTH = 1024
+IMAGE_HEIGHT = 576
+NEGATIVE_PROMPT = "blurry, low quality, distorted, deformed, ugly, bad anatomy, disfigured, poorly drawn face, mutation, mutated, extra limb, missing limb, floating limbs, disconnected limbs, malformed hands, blur, out of focus, long neck, long body, distorted proportions, bad proportions, gross proportions, text, error, missing fingers, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry"
+CINEMATIC_SUFFIX = ". Professional cinematography, 8k resolution, dramatic composition, cinematic lighting, atmospheric depth, high-end production quality."
+
+# Prompt fragments for each reference image tag
+TAG_TEMPLATES = {
+    "character": "Maintain exact character likeness from reference image '{description}', including facial features, expression, and style.",
+    "style": "Match the visual style, lighting, and atmosphere from reference image '{description}'.",
+    "location": "Use the environment and setting details from reference image '{description}'."
+}
+DEFAULT_TAG_TEMPLATE = "Incorporate elements from reference image '{description}' for {tag} consistency."
+GENERATION_CACHE_DIR = os.path.join(".cache", "leonardo")
+# Leonardo image URLs don't live forever, so cached entries expire after a day
+GENERATION_CACHE_TTL = 24 * 60 * 60
+MAX_CONCURRENT_DOWNLOADS = 10
+MAX_WAIT = 180
+BASE_DELAY = 1
+MAX_DELAY = 10
+BACKOFF_FACTOR = 1.5
+MAX_JITTER = 0.3
+# Submissions and status polling run on separate concurrency budgets
+MAX_CONCURRENT_SUBMISSIONS = 8
+NUM_POLLERS = 16
+
+# Optional webhook delivery: Leonardo calls back on completion instead of being polled
+LEONARDO_WEBHOOK_URL = os.getenv('LEONARDO_WEBHOOK_URL')
+LEONARDO_WEBHOOK_SECRET = os.getenv('LEONARDO_WEBHOOK_SECRET')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8600'))
+WEBHOOK_TIMEOUT = 120
+
+# Failures of a single API call that should only fail the scene making it
+API_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError)
 
 # Leonardo Model IDs
 MODELS = {
@@ -27,102 +70,180 @@ MODELS = {
     "PhotoReal": "291be633-cb24-434f-898f-e662799936ad"
 }
 
+@st.cache_resource
+def get_http_session():
+    """Pooled HTTP session shared across reruns and user sessions so TCP/TLS connections stay warm."""
+    session = requests.Session()
+    session.headers.update({"accept": "application/json"})
+    session.mount("https://", HTTPAdapter(
+        pool_connections=20,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[502, 503, 504],
+            # Init-image POSTs create server-side records, so only reads are retried
+            allowed_methods=frozenset(["GET"]),
+            # Hand the final 5xx back to the caller instead of raising RetryError
+            raise_on_status=False
+        )
+    ))
+    atexit.register(session.close)
+    return session
+
+def script_thread_pool(max_workers):
+    """Thread pool whose workers can still write to the current Streamlit page."""
+    return ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=add_script_run_ctx,
+        initargs=(None, get_script_run_ctx())
+    )
+
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=MAX_IMAGES)
+def fetch_bytes(url):
+    """Download an image once and keep its bytes for repeated ZIP builds."""
+    response = get_http_session().get(url)
+    response.raise_for_status()
+    return response.content
+
 def upload_reference_image(api_key, image_file, description):
     """Upload a reference image to Leonardo."""
-    headers = {
-        "accept": "application/json",
-        "authorization": f"Bearer {api_key}"
-    }
-    
-    # First, get the upload URL using POST
-    upload_url_response = requests.post(
-        f"{LEONARDO_API_URL}/init-image",
-        headers=headers
-    )
-    
-    if upload_url_response.status_code != 200:
-        st.error(f"Error getting upload URL: {upload_url_response.text}")
-        return None
-    
-    upload_data = upload_url_response.json()
-    
-    # Prepare the file for upload
-    files = {
-        'file': (image_file.name, image_file, 'image/jpeg')
-    }
-    
-    # Upload the file
-    upload_response = requests.post(
-        upload_data["uploadInitImage"]["fields"]["url"],
-        files=files,
-        data=upload_data["uploadInitImage"]["fields"]
-    )
-    
-    if upload_response.status_code != 204:
-        st.error(f"Error uploading file: {upload_response.text}")
+    try:
+        session = get_http_session()
+        # Only send credentials to Leonardo, never to the S3 upload URL
+        headers = {
+            "authorization": f"Bearer {api_key}"
+        }
+        
+        # First, get the upload URL using POST
+        upload_url_response = session.post(
+            f"{LEONARDO_API_URL}/init-image",
+            headers=headers
+        )
+        
+        if upload_url_response.status_code != 200:
+            st.error(f"Error getting upload URL: {upload_url_response.text}")
+            return None
+        
+        upload_data = upload_url_response.json()
+        
+        # Prepare the file for upload
+        files = {
+            'file': (image_file.name, image_file, 'image/jpeg')
+        }
+        
+        # Upload the file
+        upload_response = session.post(
+            upload_data["uploadInitImage"]["fields"]["url"],
+            files=files,
+            data=upload_data["uploadInitImage"]["fields"]
+        )
+        
+        if upload_response.status_code != 204:
+            st.error(f"Error uploading file: {upload_response.text}")
+            return None
+        
+        # Create the init image
+        create_payload = {
+            "name": description,
+            "uploadId": upload_data["uploadInitImage"]["uploadId"]
+        }
+        
+        create_response = session.post(
+            f"{LEONARDO_API_URL}/init-image",
+            headers=headers,
+            json=create_payload
+        )
+        
+        if create_response.status_code != 200:
+            st.error(f"Error creating init image: {create_response.text}")
+            return None
+        
+        return create_response.json()
+    except requests.RequestException as e:
+        st.error(f"Error uploading reference image: {e}")
         return None
+
+async def upload_reference_images(api_key, reference_images):
+    """Upload reference images concurrently and return the ones that succeeded with their IDs.
     
-    # Create the init image
-    create_payload = {
-        "name": description,
-        "uploadId": upload_data["uploadInitImage"]["uploadId"]
-    }
-    
-    create_response = requests.post(
-        f"{LEONARDO_API_URL}/init-image",
-        headers=headers,
-        json=create_payload
-    )
+    Uploaded IDs are remembered in session state by content hash, so reruns
+    never send the same file to Leonardo twice.
+    """
+    if "uploaded_refs" not in st.session_state:
+        st.session_state.uploaded_refs = {}
+    uploaded_ids = st.session_state.uploaded_refs
     
-    if create_response.status_code != 200:
-        st.error(f"Error creating init image: {create_response.text}")
-        return None
+    new_refs = [ref for ref in reference_images if ref["key"] not in uploaded_ids]
+    if new_refs:
+        loop = asyncio.get_running_loop()
+        # Uploads go through the pooled session on worker threads
+        with script_thread_pool(len(new_refs)) as executor:
+            results = await asyncio.gather(*(
+                loop.run_in_executor(executor, upload_reference_image, api_key, ref["image"], ref["description"])
+                for ref in new_refs
+            ))
+        
+        for ref, ref_data in zip(new_refs, results):
+            if ref_data and "uploadInitImage" in ref_data:
+                uploaded_ids[ref["key"]] = ref_data["uploadInitImage"]["id"]
+                st.success(f"Successfully uploaded reference image: {ref['description']}")
+            else:
+                st.error(f"Failed to upload reference image: {ref['description']}")
     
-    return create_response.json()
+    return [
+        {**ref, "id": uploaded_ids[ref["key"]]}
+        for ref in reference_images
+        if ref["key"] in uploaded_ids
+    ]
 
+@st.cache_data(show_spinner=False)
 def parse_script(script):
     """Parse script into scenes, where each scene consists of a script line and its description."""
     scenes = []
-    lines = script.split('\n')
-    i = 0
-    while i < len(lines):
-        line = lines[i].strip()
+    # Strip every line once up front, then pair each non-empty line with the one after it
+    lines = iter([line.strip() for line in script.split('\n')])
+    for line in lines:
         if line:
-            description = lines[i + 1].strip() if i + 1 < len(lines) and lines[i + 1].strip() else ""
             scenes.append({
                 "script": line,
-                "description": description
+                "description": next(lines, "")
             })
-            i += 2 if description else 1
-        else:
-            i += 1
     return scenes
 
+@st.cache_data(show_spinner=False)
 def generate_cinematic_prompt(scene, scene_num, reference_images=None):
-    """Generate a cinematic prompt from a scene with reference image integration."""
-    base_prompt = f"Scene {scene_num}: {scene['script']}"
-    if scene['description']:
-        base_prompt += f". {scene['description']}"
+    """Generate a cinematic prompt from a scene with reference image integration.
+    
+    Takes a (script, description) tuple and a tuple of (description, tag) pairs
+    so that Streamlit can hash the arguments and cache the result across reruns.
+    """
+    script_line, scene_description = scene
+    parts = [f"Scene {scene_num}: {script_line}"]
+    if scene_description:
+        parts.append(f". {scene_description}")
     
     # Add cinematic enhancements
-    base_prompt += ". Professional cinematography, 8k resolution, dramatic composition, cinematic lighting, atmospheric depth, high-end production quality."
+    parts.append(CINEMATIC_SUFFIX)
     
     if reference_images:
-        ref_prompts = []
-        for ref in reference_images:
-            if ref['tag'] == 'character':
-                ref_prompts.append(f"Maintain exact character likeness from reference image '{ref['description']}', including facial features, expression, and style.")
-            elif ref['tag'] == 'style':
-                ref_prompts.append(f"Match the visual style, lighting, and atmosphere from reference image '{ref['description']}'.")
-            elif ref['tag'] == 'location':
-                ref_prompts.append(f"Use the environment and setting details from reference image '{ref['description']}'.")
-            else:
-                ref_prompts.append(f"Incorporate elements from reference image '{ref['description']}' for {ref['tag']} consistency.")
-        base_prompt += " " + " ".join(ref_prompts)
+        parts.append(" ")
+        parts.append(" ".join(
+            TAG_TEMPLATES.get(tag, DEFAULT_TAG_TEMPLATE).format(description=description, tag=tag)
+            for description, tag in reference_images
+        ))
     
-    return base_prompt
+    return "".join(parts)
+
+def backoff_delay(attempt, retry_after=None):
+    """Exponential backoff with jitter, stretched to honour a Retry-After header."""
+    delay = min(MAX_DELAY, BASE_DELAY * BACKOFF_FACTOR ** attempt) + random.uniform(0, MAX_JITTER)
+    # Respect the server's requested cooldown when rate limited
+    if retry_after and retry_after.isdigit():
+        delay = max(delay, int(retry_after))
+    return delay
 
-def create_generation(api_key, prompt, model_id, reference_image_ids=None):
+async def create_generation(session, api_key, prompt, model_id, reference_image_ids=None, webhook_url=None):
     """Create a generation using Leonardo API with advanced features."""
     headers = {
         "accept": "application/json",
@@ -134,8 +255,8 @@ def create_generation(api_key, prompt, model_id, reference_image_ids=None):
     payload = {
         "prompt": prompt,
         "modelId": model_id,
-        "width": 1024,
-        "height": 576,
+        "width": IMAGE_WIDTH,
+        "height": IMAGE_HEIGHT,
         "num_images": 1
     }
     
@@ -150,41 +271,76 @@ def create_generation(api_key, prompt, model_id, reference_image_ids=None):
         payload["alchemy"] = True
         payload["promptMagic"] = True
     
-    # Add negative prompt
-    payload["negative_prompt"] = "blurry, low quality, distorted, deformed, ugly, bad anatomy, disfigured, poorly drawn face, mutation, mutated, extra limb, missing limb, floating limbs, disconnected limbs, malformed hands, blur, out of focus, long neck, long body, distorted proportions, bad proportions, gross proportions, text, error, missing fingers, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry"
+    # Ask Leonardo to notify us on completion
+    if webhook_url:
+        payload["webhookCallbackUrl"] = webhook_url
     
-    response = requests.post(
-        f"{LEONARDO_API_URL}/generations",
-        headers=headers,
-        json=payload
-    )
+    # Add negative prompt
+    payload["negative_prompt"] = NEGATIVE_PROMPT
     
-    if response.status_code != 200:
-        st.error(f"Error creating generation: {response.text}")
-        return None
+    # A rate-limited create was rejected outright, so it is safe to send again
+    deadline = time.monotonic() + MAX_WAIT
+    attempt = 0
+    while True:
+        try:
+            async with session.post(
+                f"{LEONARDO_API_URL}/generations",
+                headers=headers,
+                data=orjson.dumps(payload)
+            ) as response:
+                if response.status == 429:
+                    retry_after = response.headers.get("Retry-After")
+                elif response.status != 200:
+                    st.error(f"Error creating generation: {await response.text()}")
+                    return None
+                else:
+                    return orjson.loads(await response.read())
+        except API_ERRORS as e:
+            st.error(f"Error creating generation: {e!r}")
+            return None
         
-    return response.json()
+        delay = backoff_delay(attempt, retry_after)
+        attempt += 1
+        if time.monotonic() + delay > deadline:
+            st.error(f"Error creating generation: still rate limited after {MAX_WAIT} seconds")
+            return None
+        await asyncio.sleep(delay)
 
-def get_generation_images(api_key, generation_id):
-    """Get generated images from Leonardo API with retry logic."""
+async def get_generation_images(session, api_key, generation_id):
+    """Get generated images from Leonardo API, polling with exponential backoff."""
     headers = {
         "accept": "application/json",
         "authorization": f"Bearer {api_key}"
     }
     
-    for attempt in range(MAX_RETRIES):
-        response = requests.get(
-            f"{LEONARDO_API_URL}/generations/{generation_id}",
-            headers=headers
-        )
-        
-        if response.status_code != 200:
-            st.error(f"Error getting generation status: {response.text}")
+    deadline = time.monotonic() + MAX_WAIT
+    attempt = 0
+    while time.monotonic() < deadline:
+        retry_after = None
+        try:
+            async with session.get(
+                f"{LEONARDO_API_URL}/generations/{generation_id}",
+                headers=headers
+            ) as response:
+                status = response.status
+                if status == 429:
+                    retry_after = response.headers.get("Retry-After")
+                elif status == 200:
+                    # Let the server skip the body next time if the generation is unchanged
+                    if "ETag" in response.headers:
+                        headers["if-none-match"] = response.headers["ETag"]
+                    
+                    data = orjson.loads(await response.read())
+                elif status != 304:
+                    st.error(f"Error getting generation status: {await response.text()}")
+                    return None
+        except API_ERRORS as e:
+            st.error(f"Error getting generation status: {e!r}")
             return None
-            
-        data = response.json()
         
-        if "generations_by_pk" in data:
+        # A 304 means nothing changed since the last poll, so the job is still running;
+        # rate-limited and unchanged polls just back off below, after the connection is released
+        if status == 200 and "generations_by_pk" in data:
             generation = data["generations_by_pk"]
             if generation.get("status") == "COMPLETE":
                 if generation.get("generated_images") and len(generation["generated_images"]) > 0:
@@ -193,11 +349,256 @@ def get_generation_images(api_key, generation_id):
                 st.error(f"Generation failed: {generation.get('error', 'Unknown error')}")
                 return None
         
-        time.sleep(RETRY_DELAY)
+        await asyncio.sleep(backoff_delay(attempt, retry_after))
+        attempt += 1
     
-    st.error("Generation timed out after maximum retries")
+    st.error(f"Generation timed out after {MAX_WAIT} seconds")
     return None
 
+async def get_or_generate(prompt, model_id, reference_image_ids, generate, refresh=False):
+    """Return the cached image URL for these generation settings, or generate and cache it.
+    
+    Expired, unreadable or corrupt cache entries count as misses, and
+    ``refresh`` skips the lookup entirely to force a new generation.
+    """
+    key_args = {
+        "prompt": prompt,
+        "model_id": model_id,
+        "reference_image_ids": reference_image_ids,
+        "negative_prompt": NEGATIVE_PROMPT,
+        "width": IMAGE_WIDTH,
+        "height": IMAGE_HEIGHT
+    }
+    key = hashlib.sha256(json.dumps(key_args, sort_keys=True).encode()).hexdigest()
+    cache_path = os.path.join(GENERATION_CACHE_DIR, f"{key}.json")
+    
+    if not refresh:
+        try:
+            if time.time() - os.path.getmtime(cache_path) < GENERATION_CACHE_TTL:
+                with open(cache_path) as f:
+                    return json.load(f)["image_url"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    
+    image_url = await generate()
+    if image_url:
+        # Write to a temp file and swap it in so readers never see a partial entry
+        try:
+            os.makedirs(GENERATION_CACHE_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=GENERATION_CACHE_DIR, suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({"image_url": image_url, **key_args}, f)
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                os.remove(tmp_path)
+                raise
+        except OSError as e:
+            st.warning(f"Could not cache generated image: {e}")
+    return image_url
+
+async def start_webhook_server(pending):
+    """Start a local endpoint that resolves pending generations when Leonardo calls back."""
+    async def handle_callback(request):
+        if LEONARDO_WEBHOOK_SECRET and request.headers.get("authorization") != f"Bearer {LEONARDO_WEBHOOK_SECRET}":
+            return web.Response(status=401)
+        
+        try:
+            data = await request.json()
+            generation_id = data["data"]["object"]["id"]
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+        
+        # Only generations submitted by this run are tracked
+        future = pending.get(generation_id)
+        if future and not future.done():
+            future.set_result(data)
+        return web.Response(status=200)
+    
+    webhook_app = web.Application()
+    webhook_app.router.add_post("/{tail:.*}", handle_callback)
+    runner = web.AppRunner(webhook_app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    except OSError:
+        await runner.cleanup()
+        raise
+    return runner
+
+async def generate_images(api_key, scenes, model_id, reference_images=None, progress_bar=None, refresh_cache=False):
+    """Upload references, then pipeline all scene generations through one event loop.
+    
+    Scenes are submitted as fast as the submission budget allows and handed
+    over a queue to a fixed pool of pollers that wait for each job to finish.
+    """
+    results = [None] * len(scenes)
+    completed = 0
+    
+    async def submit_scene(i, prompt):
+        # Create generation
+        async with submission_slots:
+            generation = await create_generation(session, api_key, prompt, model_id, reference_image_ids, webhook_url)
+        
+        if not generation or "sdGenerationJob" not in generation:
+            st.error(f"Failed to create generation for scene {i+1}")
+            return None
+        
+        generation_id = generation["sdGenerationJob"]["generationId"]
+        loop = asyncio.get_running_loop()
+        if webhook_url:
+            # Register before queueing so an early callback is not dropped
+            pending[generation_id] = loop.create_future()
+        
+        # Hand the job to the pollers and wait for its image URL
+        done = loop.create_future()
+        await submitted.put((i, generation_id, loop.time(), done))
+        return await done
+    
+    async def poll_scenes():
+        while True:
+            i, generation_id, submitted_at, done = await submitted.get()
+            try:
+                # Sleep until the webhook fires, then confirm with a single status fetch;
+                # if it never arrives, get_generation_images falls back to polling.
+                # The webhook budget runs from submission, not from when a poller
+                # got to the job, so a dead tunnel costs WEBHOOK_TIMEOUT once overall
+                if webhook_url:
+                    remaining = max(0, submitted_at + WEBHOOK_TIMEOUT - asyncio.get_running_loop().time())
+                    try:
+                        await asyncio.wait_for(pending[generation_id], remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                
+                # Wait for generation to complete and get images
+                images = await get_generation_images(session, api_key, generation_id)
+                if not images:
+                    st.error(f"Failed to get images for scene {i+1}")
+                    done.set_result(None)
+                else:
+                    done.set_result(images["generations_by_pk"]["generated_images"][0]["url"])
+            except Exception as e:
+                done.set_exception(e)
+            finally:
+                submitted.task_done()
+    
+    async def process_scene(i, prompt):
+        nonlocal completed
+        image_url = await get_or_generate(
+            prompt,
+            model_id,
+            reference_image_ids,
+            lambda: submit_scene(i, prompt),
+            refresh_cache
+        )
+        if image_url:
+            results[i] = {
+                "url": image_url,
+                "prompt": prompt,
+                "scene": i,
+                "script": scenes[i]["script"]
+            }
+        
+        completed += 1
+        if progress_bar:
+            progress_bar.progress(completed / len(scenes))
+    
+    # Only references that uploaded successfully are used for the prompts
+    uploaded_refs = await upload_reference_images(api_key, reference_images) if reference_images else []
+    reference_image_ids = [ref["id"] for ref in uploaded_refs] or None
+    
+    # Hashable views of the inputs so prompt generation can be cached
+    ref_tags = tuple((ref["description"], ref["tag"]) for ref in uploaded_refs)
+    
+    prompts = []
+    for i, scene in enumerate(scenes):
+        prompt = generate_cinematic_prompt((scene["script"], scene["description"]), i+1, ref_tags)
+        st.write(f"Generating image {i+1} with prompt: {prompt}")
+        prompts.append(prompt)
+    
+    pending = {}
+    runner = None
+    if LEONARDO_WEBHOOK_URL:
+        if not LEONARDO_WEBHOOK_SECRET:
+            st.warning("LEONARDO_WEBHOOK_SECRET is not set, so webhook callbacks are accepted without authentication")
+        try:
+            runner = await start_webhook_server(pending)
+        except OSError as e:
+            st.warning(f"Webhook listener unavailable, falling back to polling: {e}")
+    webhook_url = LEONARDO_WEBHOOK_URL if runner else None
+    
+    submitted = asyncio.Queue()
+    submission_slots = asyncio.Semaphore(MAX_CONCURRENT_SUBMISSIONS)
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_SUBMISSIONS + NUM_POLLERS)
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            pollers = [asyncio.ensure_future(poll_scenes()) for _ in range(NUM_POLLERS)]
+            try:
+                await asyncio.gather(*(process_scene(i, prompt) for i, prompt in enumerate(prompts)))
+            finally:
+                for poller in pollers:
+                    poller.cancel()
+    finally:
+        if runner:
+            await runner.cleanup()
+    
+    return [result for result in results if result]
+
+def download_images(generated_images):
+    """Fetch the bytes of all generated images concurrently, in order, with None for failed downloads."""
+    def fetch(url):
+        try:
+            return fetch_bytes(url)
+        except requests.RequestException:
+            return None
+    
+    with script_thread_pool(MAX_CONCURRENT_DOWNLOADS) as executor:
+        return list(executor.map(fetch, [img_data["url"] for img_data in generated_images]))
+
+def build_images_zip(generated_images, contents):
+    """Pack the successfully downloaded images into an in-memory ZIP."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zipf:
+        for img_data, content in zip(generated_images, contents):
+            if content is not None:
+                zipf.writestr(f"scene_{img_data['scene']+1}.png", content)
+    return buffer.getvalue()
+
+@st.fragment
+def render_results():
+    """Show the generated images; reruns on its own so download clicks skip the rest of the page."""
+    generated_images = st.session_state.get("generated_images")
+    if not generated_images:
+        return
+    
+    # Display Results
+    st.header("Generated Images")
+    for img_data in generated_images:
+        i = img_data["scene"]
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            st.image(img_data["url"], caption=f"Scene {i+1}: {img_data['script']}")
+        with col2:
+            st.link_button(f"Download Scene {i+1}", img_data["url"])
+    
+    # Download All
+    if st.button("Download All Images"):
+        # Images are only pulled server-side when a ZIP is actually requested
+        contents = download_images(generated_images)
+        for img_data, content in zip(generated_images, contents):
+            if content is None:
+                st.warning(f"Could not download scene {img_data['scene']+1}; it was left out of the ZIP")
+        
+        if any(content is not None for content in contents):
+            st.download_button(
+                "Download ZIP",
+                build_images_zip(generated_images, contents),
+                file_name="generated_images.zip",
+                mime="application/zip"
+            )
+        else:
+            st.error("None of the generated images could be downloaded")
+
 def main():
     st.title("🎬 Cinematic Image Generator")
     
@@ -209,6 +610,10 @@ def main():
         help="Enter your script with each scene on a new line, followed by its description on the next line"
     )
     
+    # Results belong to the script they were generated from
+    if st.session_state.get("generated_script") != script:
+        st.session_state.pop("generated_images", None)
+    
     if script:
         scenes = parse_script(script)
         st.info(f"Total possible scenes: {len(scenes)}")
@@ -233,10 +638,11 @@ def main():
         
         # Reference Image Upload
         st.header("4. Reference Images (Optional)")
-        reference_images = []
         num_refs = st.number_input("Number of reference images (0-5):", 0, 5, 0)
         
-        uploaded_refs = []
+        # References are uploaded when generation starts, not on every rerun
+        reference_images = []
+        seen_keys = set()
         for i in range(num_refs):
             col1, col2, col3 = st.columns([2, 2, 1])
             with col1:
@@ -251,104 +657,54 @@ def main():
                 )
             
             if ref_image and description:
-                if ref_image not in [r["image"] for r in uploaded_refs]:
+                key = hashlib.blake2b(ref_image.getvalue(), digest_size=16).hexdigest()
+                if key not in seen_keys:
+                    seen_keys.add(key)
                     # Reset file pointer to beginning
                     ref_image.seek(0)
-                    # Upload reference image to Leonardo
-                    ref_data = upload_reference_image(LEONARDO_API_KEY, ref_image, description)
-                    if ref_data and "uploadInitImage" in ref_data:
-                        uploaded_refs.append({
-                            "image": ref_image,
-                            "description": description,
-                            "tag": tag,
-                            "id": ref_data["uploadInitImage"]["id"]
-                        })
-                        reference_images.append({
-                            "image": ref_image,
-                            "description": description,
-                            "tag": tag
-                        })
-                        st.success(f"Successfully uploaded reference image: {description}")
-                    else:
-                        st.error(f"Failed to upload reference image: {description}")
+                    reference_images.append({
+                        "image": ref_image,
+                        "description": description,
+                        "tag": tag,
+                        "key": key
+                    })
         
         # Generate Images
+        refresh_cache = st.checkbox(
+            "Regenerate cached images",
+            help="Ignore images cached from earlier runs with the same prompt and settings"
+        )
         if st.button("Generate Images"):
             if not LEONARDO_API_KEY:
                 st.error("Please set your Leonardo API key in the .env file")
                 return
             
             progress_bar = st.progress(0)
-            generated_images = []
             
-            # Get reference image IDs
-            ref_ids = [ref["id"] for ref in uploaded_refs] if uploaded_refs else None
-            
-            for i in range(num_images):
-                prompt = generate_cinematic_prompt(scenes[i], i+1, reference_images)
-                st.write(f"Generating image {i+1} with prompt: {prompt}")
-                
-                # Create generation
-                generation = create_generation(
+            # Keep the per-scene prompt log collapsed so it doesn't flood the page
+            with st.status("Generating images...", expanded=False) as status:
+                generated_images = asyncio.run(generate_images(
                     LEONARDO_API_KEY,
-                    prompt,
+                    scenes[:num_images],
                     MODELS[selected_model],
-                    ref_ids
-                )
-                
-                if not generation or "sdGenerationJob" not in generation:
-                    st.error(f"Failed to create generation for scene {i+1}")
-                    continue
+                    reference_images,
+                    progress_bar,
+                    refresh_cache
+                ))
+                st.session_state.generated_images = generated_images
+                st.session_state.generated_script = script
                 
-                generation_id = generation["sdGenerationJob"]["generationId"]
-                
-                # Wait for generation to complete and get images
-                images = get_generation_images(LEONARDO_API_KEY, generation_id)
-                if not images:
-                    st.error(f"Failed to get images for scene {i+1}")
-                    continue
-                
-                image_url = images["generations_by_pk"]["generated_images"][0]["url"]
-                generated_images.append({
-                    "url": image_url,
-                    "prompt": prompt
-                })
-                
-                progress_bar.progress((i + 1) / num_images)
-            
-            if generated_images:
-                # Display Results
-                st.header("Generated Images")
-                for i, img_data in enumerate(generated_images):
-                    col1, col2 = st.columns([3, 1])
-                    with col1:
-                        st.image(img_data["url"], caption=f"Scene {i+1}: {scenes[i]['script']}")
-                    with col2:
-                        st.download_button(
-                            f"Download Scene {i+1}",
-                            img_data["url"],
-                            file_name=f"scene_{i+1}.png"
-                        )
-                
-                # Download All
-                if st.button("Download All Images"):
-                    with tempfile.TemporaryDirectory() as tmpdir:
-                        zip_path = os.path.join(tmpdir, "generated_images.zip")
-                        with zipfile.ZipFile(zip_path, 'w') as zipf:
-                            for i, img_data in enumerate(generated_images):
-                                response = requests.get(img_data["url"])
-                                img_path = os.path.join(tmpdir, f"scene_{i+1}.png")
-                                with open(img_path, 'wb') as f:
-                                    f.write(response.content)
-                                zipf.write(img_path, f"scene_{i+1}.png")
-                        
-                        with open(zip_path, 'rb') as f:
-                            st.download_button(
-                                "Download ZIP",
-                                f,
-                                file_name="generated_images.zip",
-                                mime="application/zip"
-                            )
+                # Open the log on any failure so the per-scene errors are visible
+                if len(generated_images) < num_images:
+                    status.update(
+                        label=f"Generated {len(generated_images)} of {num_images} images",
+                        state="error",
+                        expanded=True
+                    )
+                else:
+                    status.update(label="Generation finished", state="complete")
+        
+        render_results()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file